@@ -4,45 +4,138 @@ LLMLingua2 Compression Module
 Handles compression using the three methods and context analysis
 """
 
-import json
-import requests
+import asyncio
+import hashlib
+import os
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from itertools import islice
 from typing import List, Dict, Any, Tuple
+import aiohttp
+import orjson
+import torch
 from datasets import load_dataset
 from llmlingua import PromptCompressor
 
+try:
+    # Optional compiled helper, build with `cythonize -i retention.pyx`
+    from retention import count_retained
+except ImportError:
+    def count_retained(original_words: List[str], compressed_set: frozenset) -> int:
+        """Count original words whose lowercase form is in compressed_set"""
+        return sum(1 for w in original_words if w.lower() in compressed_set)
+
+
+LLMLINGUA2_MODEL = "microsoft/llmlingua-2-xlm-roberta-large-meetingbank"
+
+# Placeholder answers of MS MARCO examples without a real answer
+NO_ANSWER = frozenset({'no answer', 'no answer present', 'no answer present.'})
+
+
+def memoize_tokenizer_call(func, maxsize: int = 8192):
+    """Memoize single text tokenizer calls, any other call signature passes through"""
+    cached = lru_cache(maxsize=maxsize)(lambda text: tuple(func(text)))
+    
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if len(args) == 1 and not kwargs and isinstance(args[0], str):
+            return list(cached(args[0]))
+        return func(*args, **kwargs)
+    
+    return wrapper
+
+
+def resolve_model_dtype(dtype: str) -> torch.dtype:
+    """Pick the scorer dtype, half precision only applies on GPU
+    
+    LLMLingua2 converts the softmax output to numpy, which has no bfloat16, so
+    bfloat16 is mapped to float16.
+    """
+    if dtype not in ("auto", "float16", "bfloat16", "float32"):
+        raise ValueError(f"Unsupported scorer dtype: {dtype}")
+    if dtype == "float32" or not torch.cuda.is_available():
+        return torch.float32
+    return torch.float16
+
+
+@lru_cache(maxsize=1)
+def get_prompt_compressor(model_name: str = LLMLINGUA2_MODEL, dtype: str = "auto",
+                          compile_model: bool = False) -> PromptCompressor:
+    """Load the LLMLingua2 compressor once per process and share it"""
+    print("Initializing LLMLingua2 compressor...")
+    compressor = PromptCompressor(
+        model_name=model_name,
+        use_llmlingua2=True,
+        device_map="auto"  # Will use GPU if available
+    )
+    
+    # The keep/drop classifier tolerates half precision, which halves weight traffic.
+    # Input ids and attention masks are built by LLMLingua2 and stay integer/bool
+    model_dtype = resolve_model_dtype(dtype)
+    if dtype == "bfloat16" and model_dtype == torch.float16:
+        print("bfloat16 is not supported by LLMLingua2, using float16")
+    if model_dtype != torch.float32:
+        print(f"Casting LLMLingua2 scorer to {model_dtype}")
+        compressor.model = compressor.model.to(dtype=model_dtype)
+    
+    # LLMLingua2 pads every chunk to max_seq_len, so only the batch dimension varies
+    # and the compiled graphs are reused across calls. The default mode is used since
+    # CUDA graphs keep thread local state and compression runs in per-run worker threads
+    if compile_model and torch.cuda.is_available():
+        print("Compiling LLMLingua2 scorer with torch.compile...")
+        compressor.model = torch.compile(compressor.model, dynamic=True)
+    
+    # LLMLingua2 re-tokenizes the same contexts for every method and runs tiktoken
+    # on every kept word, memoize both so repeated text is only tokenized once
+    compressor.tokenizer.tokenize = memoize_tokenizer_call(compressor.tokenizer.tokenize)
+    compressor.oai_tokenizer.encode = memoize_tokenizer_call(compressor.oai_tokenizer.encode)
+    
+    return compressor
+
 
 class ContextTracker:
     """Track context retention with separators"""
     
     def __init__(self, separator: str):
         self.separator = separator
+        self._sep_str = f" {separator} "
+        self._sep_len = len(self._sep_str)
+        # Every compression method prepares the same contexts, so memoize per example
+        self._prepare_cached = lru_cache(maxsize=256)(self._prepare)
     
     def prepare_contexts_with_separators(self, contexts: List[str]) -> Tuple[str, Dict[int, Tuple[int, int]]]:
-        """Combine contexts with separators and track positions"""
-        combined_text = ""
+        """Combine contexts with separators and track positions
+        
+        The result is shared between calls with the same contexts and must not be modified.
+        """
+        return self._prepare_cached(tuple(contexts))
+    
+    def _prepare(self, contexts: Tuple[str, ...]) -> Tuple[str, Dict[int, Tuple[int, int]]]:
+        parts = []
         context_positions = {}
         current_pos = 0
         
         for i, context in enumerate(contexts):
             if i > 0:
-                combined_text += f" {self.separator} "
-                current_pos += len(f" {self.separator} ")
+                parts.append(self._sep_str)
+                current_pos += self._sep_len
             
             start_pos = current_pos
-            combined_text += context
+            parts.append(context)
             current_pos += len(context)
-            end_pos = current_pos
-            
-            context_positions[i] = (start_pos, end_pos)
             
+            context_positions[i] = (start_pos, current_pos)
+        
+        combined_text = "".join(parts)
         return combined_text, context_positions
     
     def analyze_context_retention(self, original_text: str, compressed_text: str, 
                                 context_positions: Dict[int, Tuple[int, int]]) -> Dict[int, Dict[str, Any]]:
         """Analyze which tokens from each context are retained"""
         cleaned_compressed = compressed_text.replace(self.separator, " ").strip()
-        compressed_words = cleaned_compressed.split()
+        compressed_set = frozenset(w.lower() for w in cleaned_compressed.split())
         
         context_stats = {}
         
@@ -51,10 +144,7 @@ class ContextTracker:
             original_words = original_context_text.split()
             
             # Count retained words (including repetitions)
-            retained_count = 0
-            for word in original_words:
-                if word.lower() in [w.lower() for w in compressed_words]:
-                    retained_count += 1
+            retained_count = count_retained(original_words, compressed_set)
             
             context_stats[context_id] = {
                 'original_length': len(original_words),
@@ -65,15 +155,57 @@ class ContextTracker:
         return context_stats
 
 
+def is_valid_example(example_query_type: str, answers: List[str], query_type: str) -> bool:
+    """Keep examples of the requested query type that have a real answer"""
+    if example_query_type != query_type:
+        return False
+    
+    if not answers or not answers[0]:
+        return False
+    
+    return answers[0].strip().lower() not in NO_ANSWER
+
+
+# Transient API statuses that are retried with backoff
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+
+
 class ScaleDownAPI:
-    """Simple API client for ScaleDown"""
+    """Simple async API client for ScaleDown"""
     
-    def __init__(self, api_key: str, base_url: str, model: str = "gemini/gemini-2.0-flash"):
+    def __init__(self, api_key: str, base_url: str, model: str = "gemini/gemini-2.0-flash",
+                 max_concurrency: int = 8, max_retries: int = 3, backoff_factor: float = 0.3):
         self.api_key = api_key
         self.base_url = base_url
         self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.semaphore = None
+    
+    def create_session(self) -> aiohttp.ClientSession:
+        """Create a pooled keep-alive session, must be called from inside the running event loop"""
+        # Fresh semaphore for the new event loop, see get_response
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=60, sock_connect=5),
+            json_serialize=lambda obj: orjson.dumps(obj).decode()
+        )
+    
+    async def post_with_retries(self, session: aiohttp.ClientSession, headers: Dict, payload: Dict) -> Dict:
+        """POST payload, retrying transient failures with exponential backoff"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.post(self.base_url, headers=headers, json=payload) as response:
+                    if response.status not in RETRY_STATUSES or attempt == self.max_retries:
+                        return await response.json(loads=orjson.loads, content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
     
-    def get_response(self, context: str, prompt: str) -> str:
+    async def get_response(self, session: aiohttp.ClientSession, context: str, prompt: str) -> str:
         """Get response from API"""
         payload = {
             "context": context,
@@ -83,24 +215,21 @@ class ScaleDownAPI:
         }
         
         headers = {
-            'x-api-key': self.api_key,
-            'Content-Type': 'application/json'
+            'x-api-key': self.api_key
         }
         #print(self.api_key)
         #print(self.base_url)
         #print(self.model)
         #print(context)
         print(prompt)
+        # Bound in-flight requests to respect the API rate limits, whichever session is used
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
         try:
-            response = requests.post(self.base_url, headers=headers, data=json.dumps(payload))
-            #print(response.json().get('full_response'))
-            # Debug response details
-            #print(f"Response Status Code: {response.status_code}")
-            #print(f"Response Headers: {dict(response.headers)}")
-            #print(response.json().get('full_response'))
-            #if response.status_code == 200:
-
-            return response.json().get('full_response')
+            async with self.semaphore:
+                data = await self.post_with_retries(session, headers, payload)
+            
+            return data.get('full_response')
         except Exception as e:
             print(f"API Error: {e}")
         
@@ -111,65 +240,137 @@ class LLMLingua2Compressor:
     """Main compression class"""
     
     def __init__(self, config_path: str = "config.json", external_dataset_path: str= None):
-        with open(config_path, 'r') as f:
-            self.config = json.load(f)
+        with open(config_path, 'rb') as f:
+            self.config = orjson.loads(f.read())
         self.external_dataset_path = external_dataset_path
+        self.cache_dir = self.config.get('compressor_config', {}).get('cache_dir', '.cache/compress')
         # Initialize components
         self.context_tracker = ContextTracker(self.config['context_separator'])
         self.api_client = ScaleDownAPI(
             self.config['api_config']['api_key'],
             self.config['api_config']['base_url'],
-            self.config['api_config']['model']
+            self.config['api_config']['model'],
+            self.config['api_config'].get('max_concurrency', 8)
         )
         
-        # Initialize LLMLingua2 compressor
-        print("Initializing LLMLingua2 compressor...")
-        self.compressor = PromptCompressor(
-            model_name="microsoft/llmlingua-2-xlm-roberta-large-meetingbank",
-            use_llmlingua2=True,
-            device_map="auto"  # Will use GPU if available
+        # Initialize LLMLingua2 compressor (loaded once per process)
+        compressor_config = self.config.get('compressor_config', {})
+        self.compressor = get_prompt_compressor(
+            dtype=compressor_config.get('dtype', 'auto'),
+            compile_model=compressor_config.get('compile', False)
         )
 
     def load_external_json_dataset(self, file_path: str) -> List[Dict]:
         print(f"Loading external dataset from {file_path}...")
-        with open(file_path, 'r') as f:
-            data=json.load(f)
+        with open(file_path, 'rb') as f:
+            data = orjson.loads(f.read())
         return data
     
     def load_dataset(self) -> List[Dict]:
         """Load and filter MS MARCO dataset or external dataset if provided"""
+        dataset_config = self.config['dataset_config']
+        query_type = dataset_config['query_type']
+        max_examples = dataset_config['max_examples']
+        # The first start - 1 valid examples are skipped
+        skip = max(dataset_config['start'] - 1, 0)
+        
         if self.external_dataset_path is not None:
             # Load external dataset
             dataset = self.load_external_json_dataset(self.external_dataset_path)
+            valid_examples = (example for example in dataset
+                              if is_valid_example(example['query_type'], example['answers'], query_type))
+            filtered_examples = list(islice(valid_examples, skip, skip + max_examples))
         else:
             # Load MS MARCO dataset as before
             print("Loading MS MARCO dataset...")
-            dataset = load_dataset('microsoft/ms_marco', self.config['dataset_config']['version'])['validation']
-        
-        numeric_example_count = 0
-        filtered_examples = []
-        for example in dataset:
-            if len(filtered_examples) >= self.config['dataset_config']['max_examples']:
-                break
-                
-            if example['query_type'] != self.config['dataset_config']['query_type']:
-                continue
-                
-            if not example['answers'] or not example['answers'][0]:
-                continue
-                
-            if example['answers'][0].lower().strip() in ['no answer', 'no answer present', 'no answer present.']:
-                continue
-            numeric_example_count += 1
-            if numeric_example_count < self.config['dataset_config']['start']:
-                continue
-            filtered_examples.append(example)
+            dataset = load_dataset('microsoft/ms_marco', dataset_config['version'])['validation']
+            
+            # Filter on the Arrow columns so rejected rows are never decoded into dicts
+            dataset = dataset.filter(
+                is_valid_example,
+                input_columns=['query_type', 'answers'],
+                fn_kwargs={'query_type': query_type},
+                num_proc=dataset_config.get('num_proc', 4)
+            )
+            end = min(skip + max_examples, len(dataset))
+            filtered_examples = list(dataset.select(range(min(skip, end), end)))
         
         print(f"Loaded {len(filtered_examples)} examples")
         return filtered_examples
         
     
+    def cache_key(self, contexts: List[str], query: str, method_config: Dict) -> str:
+        """Hash everything that determines a compression result"""
+        key_data = {
+            'ctx': contexts,
+            'q': query,
+            'm': method_config,
+            'model': LLMLINGUA2_MODEL,
+            # Precision actually used, so CPU and GPU runs never share entries
+            'dtype': str(resolve_model_dtype(self.config.get('compressor_config', {}).get('dtype', 'auto'))),
+            'sep': self.config['context_separator']
+        }
+        return hashlib.blake2b(orjson.dumps(key_data, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+    
+    def load_cached_compression(self, key: str) -> Dict:
+        """Load a compression result stored by an earlier run, None on a miss
+        
+        The cache is optional, so unreadable or malformed entries count as a miss.
+        """
+        if self.cache_dir is None:
+            return None
+        
+        try:
+            with open(os.path.join(self.cache_dir, f"{key}.json"), 'rb') as f:
+                compression_result = orjson.loads(f.read())
+            
+            # JSON turns the context ids into strings
+            compression_result['context_analysis'] = {
+                int(context_id): stats for context_id, stats in compression_result['context_analysis'].items()
+            }
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, AttributeError, TypeError) as e:
+            print(f"Ignoring compression cache entry {key}: {e}")
+            return None
+        
+        return compression_result
+    
+    def store_cached_compression(self, key: str, compression_result: Dict):
+        """Store a compression result for later runs, failed compressions are not cached
+        
+        Cache write errors are logged and the store is skipped.
+        """
+        if self.cache_dir is None or 'error' in compression_result:
+            return
+        
+        tmp_file = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a unique temp file then rename, so an interrupted run never leaves a
+            # truncated entry and concurrent runs never share a temp file
+            fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(orjson.dumps(compression_result, option=orjson.OPT_NON_STR_KEYS, default=str))
+            os.replace(tmp_file, os.path.join(self.cache_dir, f"{key}.json"))
+        except OSError as e:
+            print(f"Skipping compression cache store {key}: {e}")
+            if tmp_file is not None and os.path.exists(tmp_file):
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+    
     def compress_with_method(self, contexts: List[str], query: str, method_config: Dict) -> Dict:
+        """Apply compression method, reusing results cached on disk by earlier runs"""
+        key = self.cache_key(contexts, query, method_config)
+        compression_result = self.load_cached_compression(key)
+        if compression_result is None:
+            compression_result = self.compress_uncached(contexts, query, method_config)
+            self.store_cached_compression(key, compression_result)
+        return compression_result
+    
+    def compress_uncached(self, contexts: List[str], query: str, method_config: Dict) -> Dict:
         """Apply compression method"""
         # Prepare contexts with separators
         combined_context, context_positions = self.context_tracker.prepare_contexts_with_separators(contexts)
@@ -230,8 +431,99 @@ class LLMLingua2Compressor:
                 'error': str(e)
             }
     
-    def process_example(self, example: Dict) -> Dict:
-        """Process a single example through all compression methods"""
+    def compress_batch_with_method(self, contexts_list: List[List[str]], queries: List[str],
+                                   method_config: Dict) -> List[Dict]:
+        """Apply compression method to several examples at once
+        
+        Only the rate method scores every context independently, so it is the only one
+        whose contexts can share LLMLingua2 forward passes across examples. The other
+        methods derive their budget from the whole example and are run one by one.
+        """
+        if 'rate' not in method_config or len(contexts_list) == 1:
+            return [self.compress_with_method(contexts, query, method_config)
+                    for contexts, query in zip(contexts_list, queries)]
+        
+        # Only examples missing from the disk cache go through LLMLingua2
+        keys = [self.cache_key(contexts, query, method_config)
+                for contexts, query in zip(contexts_list, queries)]
+        compression_results = [self.load_cached_compression(key) for key in keys]
+        missing = [i for i, compression_result in enumerate(compression_results) if compression_result is None]
+        if not missing:
+            return compression_results
+        
+        prepared = [self.context_tracker.prepare_contexts_with_separators(contexts_list[i])
+                    for i in missing]
+        combined_contexts = [combined_context for combined_context, _ in prepared]
+        force_tokens = [self.config['context_separator'], '\n', '.', '?']
+        
+        try:
+            # LLMLingua2 does not condition on the question, and the context level
+            # filter must stay off so each example is compressed on its own
+            result = self.compressor.compress_prompt(
+                context=combined_contexts,
+                rate=method_config['rate'],
+                force_tokens=force_tokens,
+                use_context_level_filter=False,
+                use_token_level_filter=True
+            )
+        except Exception as e:
+            print(f"Batched compression failed, falling back to single examples: {e}")
+            for i in missing:
+                compression_results[i] = self.compress_with_method(contexts_list[i], queries[i], method_config)
+            return compression_results
+        
+        for i, (combined_context, context_positions), compressed_prompt in zip(
+                missing, prepared, result['compressed_prompt_list']):
+            original_tokens = self.compressor.get_token_length(combined_context, use_oai_tokenizer=True)
+            compressed_tokens = self.compressor.get_token_length(compressed_prompt, use_oai_tokenizer=True)
+            ratio = 1 if compressed_tokens == 0 else original_tokens / compressed_tokens
+            
+            context_analysis = self.context_tracker.analyze_context_retention(
+                combined_context, compressed_prompt, context_positions
+            )
+            
+            compression_results[i] = {
+                'compressed_prompt': compressed_prompt,
+                'compression_rate': f"{1 / ratio * 100:.1f}%",
+                'compression_ratio': f"{ratio:.1f}x",
+                'original_tokens': original_tokens,
+                'compressed_tokens': compressed_tokens,
+                'context_analysis': context_analysis
+            }
+            self.store_cached_compression(keys[i], compression_results[i])
+        
+        return compression_results
+    
+    def compress_examples(self, examples: List[Dict]) -> List[Dict[str, Dict]]:
+        """Run every compression method over a batch of examples"""
+        contexts_list = [example['passages']['passage_text'] for example in examples]
+        queries = [example['query'] for example in examples]
+        
+        compressed = [{} for _ in examples]
+        for method_name, method_config in self.config['compression_methods'].items():
+            print(f"  Compressing {len(examples)} examples with {method_name}...")
+            method_results = self.compress_batch_with_method(contexts_list, queries, method_config)
+            for example_results, compression_result in zip(compressed, method_results):
+                example_results[method_name] = compression_result
+        
+        return compressed
+    
+    def length_buckets(self, examples: List[Dict]) -> List[List[int]]:
+        """Group example indices into batches of similar context length"""
+        batch_size = self.config.get('compressor_config', {}).get('batch_size', 16)
+        order = sorted(range(len(examples)),
+                       key=lambda i: sum(len(p) for p in examples[i]['passages']['passage_text']))
+        return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    
+    async def process_example(self, session: aiohttp.ClientSession, example: Dict,
+                              compressed: Dict[str, Dict] = None) -> Dict:
+        """Process a single example through all compression methods
+        
+        compressed holds precomputed compression results per method, as returned by
+        compress_examples. Missing methods are compressed here. All API requests of
+        the example are issued concurrently.
+        """
+        compressed = dict(compressed or {})
         query = example['query']
         contexts = example['passages']['passage_text']
         ground_truth = example['answers'][0]
@@ -246,7 +538,21 @@ class LLMLingua2Compressor:
         
         # Original (uncompressed) prompt
         original_context = "\n\n".join(contexts)
-        original_response = self.api_client.get_response(original_context, query)
+        
+        # Apply each compression method
+        method_names = list(self.config['compression_methods'])
+        for method_name in method_names:
+            if method_name not in compressed:
+                print(f"  Processing {method_name}...")
+                method_config = self.config['compression_methods'][method_name]
+                compressed[method_name] = self.compress_with_method(contexts, query, method_config)
+        
+        # Get API responses for original and compressed contexts
+        original_response, *compressed_responses = await asyncio.gather(
+            self.api_client.get_response(session, original_context, query),
+            *(self.api_client.get_response(session, compressed[method_name]['compressed_prompt'], query)
+              for method_name in method_names)
+        )
         
         result['original'] = {
             'context': original_context,
@@ -254,24 +560,76 @@ class LLMLingua2Compressor:
             'token_count': len(original_context.split())
         }
         
-        # Apply each compression method
-        for method_name, method_config in self.config['compression_methods'].items():
-            print(f"  Processing {method_name}...")
-            
-            compression_result = self.compress_with_method(contexts, query, method_config)
-            compressed_context = compression_result['compressed_prompt']
-            
-            # Get API response for compressed context
-            compressed_response = self.api_client.get_response(compressed_context, query)
-            
+        for method_name, compressed_response in zip(method_names, compressed_responses):
+            compression_result = compressed[method_name]
             result[method_name] = {
                 'compression_result': compression_result,
                 'response': compressed_response,
-                'context': compressed_context
+                'context': compression_result['compressed_prompt']
             }
         
         return result
     
+    async def process_examples(self, examples: List[Dict]) -> List[Dict]:
+        """Compress and process all examples as a two stage pipeline
+        
+        A single worker thread compresses length bucketed batches on the GPU while the
+        event loop sends API requests for buckets that are already compressed.
+        """
+        loop = asyncio.get_running_loop()
+        # Unbounded, compressed buckets are handed to API tasks as soon as they are ready
+        queue = asyncio.Queue()
+        results = [None] * len(examples)
+        
+        async def compress_stage():
+            # One worker so compression never competes for the GPU or the shared tokenizer
+            try:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    for bucket in self.length_buckets(examples):
+                        try:
+                            bucket_results = await loop.run_in_executor(
+                                executor, self.compress_examples, [examples[i] for i in bucket]
+                            )
+                            await queue.put(list(zip(bucket, bucket_results)))
+                            continue
+                        except Exception as e:
+                            print(f"Error compressing batch, retrying examples one by one: {e}")
+                        
+                        # Retry on the same worker so the fallback never blocks the event loop
+                        compressed_bucket = []
+                        for i in bucket:
+                            try:
+                                example_results = await loop.run_in_executor(
+                                    executor, self.compress_examples, [examples[i]]
+                                )
+                            except Exception as e:
+                                print(f"Error compressing example {i+1}: {e}")
+                                continue
+                            compressed_bucket.append((i, example_results[0]))
+                        await queue.put(compressed_bucket)
+            finally:
+                await queue.put(None)
+        
+        async with self.api_client.create_session() as session:
+            async def api_stage(i: int, compressed: Dict[str, Dict]):
+                example = examples[i]
+                print(f"Processing example {i+1}/{len(examples)}: {example['query'][:50]}...")
+                
+                try:
+                    results[i] = await self.process_example(session, example, compressed)
+                except Exception as e:
+                    print(f"Error processing example {i+1}: {e}")
+            
+            producer = asyncio.create_task(compress_stage())
+            api_tasks = []
+            while (compressed_bucket := await queue.get()) is not None:
+                api_tasks.extend(asyncio.create_task(api_stage(i, compressed))
+                                 for i, compressed in compressed_bucket)
+            await producer
+            await asyncio.gather(*api_tasks)
+        
+        return [result for result in results if result is not None]
+    
     def run_compression(self, num_examples: int = None) -> List[Dict]:
         """Run compression on dataset"""
         examples = self.load_dataset()
@@ -281,23 +639,14 @@ class LLMLingua2Compressor:
         
         print(f"Processing {len(examples)} examples...")
         
-        results = []
-        for i, example in enumerate(examples):
-            print(f"Processing example {i+1}/{len(examples)}: {example['query'][:50]}...")
-            
-            try:
-                result = self.process_example(example)
-                results.append(result)
-            except Exception as e:
-                print(f"Error processing example {i+1}: {e}")
-                continue
-        
-        return results
+        return asyncio.run(self.process_examples(examples))
     
     def save_results(self, results: List[Dict], output_file: str):
         """Save compression results"""
-        with open(output_file, 'w') as f:
-            json.dump(results, f, indent=2, default=str)
+        # Context analysis is keyed by context index, hence OPT_NON_STR_KEYS
+        options = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(results, option=options, default=str))
         print(f"Results saved to {output_file}")
 
 
@@ -3,11 +3,44 @@
 Corrected MS MARCO evaluator using ms_marco_eval.py
 """
 
-import json
+import importlib
+import re
 import subprocess
 import sys
 import os
-from typing import List, Dict
+from typing import List, Dict, Tuple
+import ijson
+import orjson
+
+
+# Metrics reported by both evaluation paths
+_METRIC_NAME = r'rouge[_\-]?\w*|bleu[_\-]?\w*|f1|exact\w*'
+_METRIC_NAME_RE = re.compile(rf'(?i)(?:{_METRIC_NAME})')
+
+# "metric: value" lines printed by ms_marco_eval.py
+_METRIC_RE = re.compile(
+    rf'(?i)^\s*({_METRIC_NAME})\s*:\s*([-+]?\d*\.?\d+(?:e[-+]?\d+)?)\s*$'
+)
+
+
+def load_results(results_file: str) -> List[Dict]:
+    """Stream compression results, keeping only the fields evaluation needs"""
+    
+    results = []
+    
+    with open(results_file, 'rb') as f:
+        for result in ijson.items(f, 'item', use_float=True):
+            # Drop contexts and compression details, only responses are scored
+            slim_result = {
+                'query_id': result['query_id'],
+                'ground_truth': result['ground_truth']
+            }
+            for key, value in result.items():
+                if isinstance(value, dict) and 'response' in value:
+                    slim_result[key] = {'response': value['response']}
+            results.append(slim_result)
+    
+    return results
 
 
 class CorrectMSMARCOEvaluator:
@@ -36,44 +69,92 @@ class CorrectMSMARCOEvaluator:
             print(f"  ✅ bleu.py           (BLEU dependency)")
             print(f"  ⭕ run.sh            (Optional)")
             sys.exit(1)
+        
+        # Prefer calling ms_marco_eval in-process, the subprocess is kept as fallback
+        self.eval_module = None
+        eval_dir = os.path.dirname(os.path.abspath(self.eval_script))
+        if eval_dir not in sys.path:
+            sys.path.insert(0, eval_dir)
+        try:
+            self.eval_module = importlib.import_module('ms_marco_eval')
+        except Exception as e:
+            print(f"⚠️ Could not import ms_marco_eval ({e}), falling back to subprocess")
+        
+        if self.eval_module is not None and not hasattr(self.eval_module, 'compute_metrics_from_files'):
+            print("⚠️ ms_marco_eval has no compute_metrics_from_files, falling back to subprocess")
+            self.eval_module = None
     
-    def format_predictions(self, results: List[Dict], method: str, output_file: str):
-        """Format results for MS MARCO evaluation"""
+    def format_files(self, results: List[Dict], methods: List[str], output_dir: str) -> Tuple[str, Dict[str, str]]:
+        """Format ground truth and every method's predictions for MS MARCO evaluation in one pass"""
         
-        formatted_data = {}
+        references = {}
+        predictions = {method: {} for method in methods}
         
         for result in results:
             query_id = str(result['query_id'])
+            references[query_id] = [result['ground_truth']]  # MS MARCO expects list format
             
-            if method in result and 'response' in result[method]:
-                response = result[method]['response'] or "No Answer Present."
-            else:
-                response = "No Answer Present."
-            
-            formatted_data[query_id] = response
+            for method in methods:
+                if method in result and 'response' in result[method]:
+                    response = result[method]['response'] or "No Answer Present."
+                else:
+                    response = "No Answer Present."
+                
+                predictions[method][query_id] = response
+        
+        references_file = os.path.join(output_dir, 'references.json')
+        with open(references_file, 'wb') as f:
+            f.write(orjson.dumps(references, option=orjson.OPT_INDENT_2))
         
-        with open(output_file, 'w') as f:
-            json.dump(formatted_data, f, indent=2)
+        predictions_files = {}
+        for method, formatted_data in predictions.items():
+            predictions_file = os.path.join(output_dir, f'predictions_{method}.json')
+            with open(predictions_file, 'wb') as f:
+                f.write(orjson.dumps(formatted_data, option=orjson.OPT_INDENT_2))
+            predictions_files[method] = predictions_file
         
-        return output_file
+        return references_file, predictions_files
     
-    def format_references(self, results: List[Dict], output_file: str):
-        """Format ground truth for MS MARCO evaluation"""
+    def run_evaluation(self, references_file: str, predictions_file: str):
+        """Run MS MARCO evaluation using ms_marco_eval.py"""
         
-        references = {}
+        if self.eval_module is not None:
+            return self.run_evaluation_in_process(references_file, predictions_file)
+        return self.run_evaluation_subprocess(references_file, predictions_file)
+    
+    def run_evaluation_in_process(self, references_file: str, predictions_file: str):
+        """Run MS MARCO evaluation by calling ms_marco_eval directly"""
         
-        for result in results:
-            query_id = str(result['query_id'])
-            ground_truth = result['ground_truth']
-            references[query_id] = [ground_truth]  # MS MARCO expects list format
+        max_bleu_order = getattr(self.eval_module, 'MAX_BLEU_ORDER', 4)
         
-        with open(output_file, 'w') as f:
-            json.dump(references, f, indent=2)
+        print(f"Running: ms_marco_eval.compute_metrics_from_files({references_file}, {predictions_file})")
         
-        return output_file
+        try:
+            scores = self.eval_module.compute_metrics_from_files(
+                references_file, predictions_file, max_bleu_order
+            )
+        except Exception as e:
+            print(f"❌ Evaluation failed: {e}")
+            return {'error': str(e), 'success': False}
+        
+        output = "\n".join(f"{name}: {value}" for name, value in sorted(scores.items()))
+        print("MS MARCO Output:")
+        print(output)
+        
+        metrics = {}
+        for metric_name, metric_value in scores.items():
+            # Same metric set as the subprocess path
+            if not _METRIC_NAME_RE.fullmatch(str(metric_name).strip()):
+                continue
+            try:
+                metrics[metric_name.lower().replace('-', '_')] = float(metric_value)
+            except (TypeError, ValueError):
+                pass
+        
+        return {'metrics': metrics, 'raw_output': output, 'success': True}
     
-    def run_evaluation(self, references_file: str, predictions_file: str):
-        """Run MS MARCO evaluation using ms_marco_eval.py"""
+    def run_evaluation_subprocess(self, references_file: str, predictions_file: str):
+        """Run MS MARCO evaluation by spawning ms_marco_eval.py"""
         
         cmd = [sys.executable, self.eval_script, references_file, predictions_file]
         
@@ -88,16 +169,11 @@ class CorrectMSMARCOEvaluator:
             print(output)
             
             # Parse metrics from output (may need adjustment based on actual output format)
-            metrics = {}
-            for line in output.split('\n'):
-                if ':' in line and any(metric in line.lower() for metric in ['rouge', 'bleu', 'f1', 'exact']):
-                    try:
-                        parts = line.split(':')
-                        metric_name = parts[0].strip()
-                        metric_value = float(parts[1].strip())
-                        metrics[metric_name.lower().replace('-', '_')] = metric_value
-                    except:
-                        pass
+            metrics = {
+                m.group(1).lower().replace('-', '_'): float(m.group(2))
+                for line in output.split('\n')
+                if (m := _METRIC_RE.match(line))
+            }
             
             return {'metrics': metrics, 'raw_output': output, 'success': True}
             
@@ -111,25 +187,20 @@ class CorrectMSMARCOEvaluator:
         
         os.makedirs(output_dir, exist_ok=True)
         
-        # Create references file (same for all methods)
-        references_file = os.path.join(output_dir, 'references.json')
-        self.format_references(results, references_file)
-        
         methods = ['original', 'method1_rate', 'method2_target_tokens', 'method3_target_contexts']
         all_results = {}
         
+        # Create references file (same for all methods) and predictions files
+        references_file, predictions_files = self.format_files(results, methods, output_dir)
+        
         print(f"Running MS MARCO evaluation on {len(results)} examples...")
         print("="*60)
         
         for method in methods:
             print(f"\n📊 Evaluating {method}...")
             
-            # Create predictions file for this method
-            predictions_file = os.path.join(output_dir, f'predictions_{method}.json')
-            self.format_predictions(results, method, predictions_file)
-            
             # Run evaluation
-            eval_result = self.run_evaluation(references_file, predictions_file)
+            eval_result = self.run_evaluation(references_file, predictions_files[method])
             all_results[method] = eval_result
             
             if eval_result.get('success'):
@@ -142,8 +213,8 @@ class CorrectMSMARCOEvaluator:
         
         # Save all results
         results_file = os.path.join(output_dir, 'msmarco_results.json')
-        with open(results_file, 'w') as f:
-            json.dump(all_results, f, indent=2)
+        with open(results_file, 'wb') as f:
+            f.write(orjson.dumps(all_results, option=orjson.OPT_INDENT_2))
         
         print(f"\n🎉 Evaluation completed!")
         print(f"📁 Results: {results_file}")
@@ -172,8 +243,7 @@ def main():
     args = parser.parse_args()
     
     # Load results
-    with open(args.results_file, 'r') as f:
-        results = json.load(f)
+    results = load_results(args.results_file)
     
     # Run evaluation
     evaluator = CorrectMSMARCOEvaluator()
@@ -0,0 +1,20 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled word retention counting for ContextTracker.analyze_context_retention
+Build in place with: cythonize -i retention.pyx
+"""
+
+
+cpdef Py_ssize_t count_retained(list original_words, frozenset compressed_set):
+    """Count original words whose lowercase form is in compressed_set"""
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = len(original_words)
+    cdef Py_ssize_t retained_count = 0
+    cdef str word
+    
+    for i in range(n):
+        word = <str>original_words[i]
+        if word.lower() in compressed_set:
+            retained_count += 1
+    
+    return retained_count
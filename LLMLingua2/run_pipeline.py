@@ -45,22 +45,22 @@ def run_compression(num_examples=None):
     """Run compression phase"""
     
     from datetime import datetime
+    from llmlingua_compressor import LLMLingua2Compressor
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_file = f'compression_results_{timestamp}.json'
     
-    cmd = [sys.executable, 'llmlingua_compressor.py', '--output', output_file]
-    if num_examples:
-        cmd.extend(['--num_examples', str(num_examples)])
-    
     print("="*50)
     print("COMPRESSION PHASE")
     print("="*50)
-    print(f"Command: {' '.join(cmd)}")
     
-    result = os.system(' '.join(cmd))
-    if result != 0:
-        print("❌ Compression failed")
-        sys.exit(1)
+    # Run in-process so the LLMLingua2 model is loaded once and stays resident
+    try:
+        compressor = LLMLingua2Compressor('config.json')
+        results = compressor.run_compression(num_examples)
+        compressor.save_results(results, output_file)
+    except Exception as e:
+        print(f"❌ Compression failed: {e}")
+        raise
     
     print(f"✅ Compression completed: {output_file}")
     return output_file
@@ -70,25 +70,23 @@ def run_evaluation(compression_file):
     """Run MS MARCO evaluation phase"""
     
     from datetime import datetime
+    from msmarco_evaluator import CorrectMSMARCOEvaluator, load_results
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     eval_dir = f'msmarco_eval_{timestamp}'
     
-    cmd = [
-        sys.executable, 'msmarco_evaluator.py',
-        '--results_file', compression_file,
-        '--output_dir', eval_dir
-    ]
-    
     print("\n" + "="*50)
     print("MS MARCO EVALUATION PHASE (CORRECTED)")
     print("="*50)
     print(f"Using: evaluation/ms_marco_eval.py")
-    print(f"Command: {' '.join(cmd)}")
     
-    result = os.system(' '.join(cmd))
-    if result != 0:
-        print("❌ Evaluation failed")
-        sys.exit(1)
+    # Run in-process to skip a fresh interpreter and keep exception details
+    try:
+        results = load_results(compression_file)
+        evaluator = CorrectMSMARCOEvaluator()
+        evaluator.evaluate_all_methods(results, eval_dir)
+    except Exception as e:
+        print(f"❌ Evaluation failed: {e}")
+        raise
     
     print(f"✅ Evaluation completed: {eval_dir}")
     return eval_dir